@@ -17,6 +17,7 @@ import torch
 from torch.utils.data import Dataset
 
 import albumentations as A
+from numba import njit
 
 import sys
 from pathlib import Path
@@ -49,31 +50,57 @@ def gaussian_radius(det_size, min_overlap=0.7):
 
 def gaussian2D(shape, sigma=1):
     m, n = [(ss - 1.) / 2. for ss in shape]
-    y, x = np.ogrid[-m:m+1, -n:n+1]
+    y, x = np.arange(-m, m + 1), np.arange(-n, n + 1)
 
-    h = np.exp(-(x * x + y * y) / (2 * sigma * sigma))
+    # 等方ガウシアンは分離可能なので、1次元ガウシアンの外積で計算する（expの評価回数を削減）
+    h = np.outer(np.exp(-(y * y) / (2 * sigma * sigma)), np.exp(-(x * x) / (2 * sigma * sigma)))
     h[h < np.finfo(h.dtype).eps * h.max()] = 0
     return h
 
 
-def draw_gaussian(heatmap, center, radius, k=1):
-    diameter = 2 * radius + 1
-    gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6)
+@njit(cache=True, fastmath=True)
+def _draw_gaussian_numba(heatmap2d, cx, cy, radius, gaussian, k):
+    # ヒートマップ内にクリップした窓を一度だけ走査し、スタンプとの最大値をin-placeで書き込む
+    height, width = heatmap2d.shape
+    for y in range(max(0, cy - radius), min(height, cy + radius + 1)):
+        for x in range(max(0, cx - radius), min(width, cx + radius + 1)):
+            v = gaussian[y - cy + radius, x - cx + radius] * k
+            if v > heatmap2d[y, x]:
+                heatmap2d[y, x] = v
 
-    x, y = int(center[0]), int(center[1])
 
-    height, width = heatmap.shape[0:2]
+# JITコンパイルをプロセス起動時に一度だけ済ませておく
+_draw_gaussian_numba(np.zeros((1, 1), dtype=np.float32), 0, 0, 0, np.ones((1, 1), dtype=np.float32), 1)
 
-    left, right = min(x, radius), min(width - x, radius + 1)
-    top, bottom = min(y, radius), min(height - y, radius + 1)
 
-    masked_heatmap = heatmap[y - top:y + bottom, x - left:x + right]
-    masked_gaussian = gaussian[radius - top:radius + bottom, radius - left:radius + right]
-    if min(masked_gaussian.shape) > 0 and min(masked_heatmap.shape) > 0:  # TODO debug
-        np.maximum(masked_heatmap, masked_gaussian * k, out=masked_heatmap)
+def draw_gaussians(heatmap, centers, indices, gaussian, radius, k=1):
+    # heatmap: (C, H, W), centers: (N, 2) の整数座標 (x, y), indices: (N,) の描画先チャネル
+    for index, (x, y) in zip(indices, centers):
+        _draw_gaussian_numba(heatmap[index], x, y, radius, gaussian, k)
     return heatmap
 
 
+def get_resize_only_transform(transform: Optional[A.Compose]) -> Optional[A.Resize]:
+    # transformがResizeのみで構成されている場合はそのResizeを返す（それ以外はNone）
+    if transform is None or transform.p < 1.0 or len(transform.transforms) != 1:
+        return None
+    resize = transform.transforms[0]
+    if not isinstance(resize, A.Resize) or resize.p < 1.0:
+        return None
+    return resize
+
+
+def resize_with_keypoints(image: np.ndarray, keypoints: np.ndarray, resize: A.Resize) -> tuple[np.ndarray, np.ndarray]:
+    # A.Resizeと同じ補間で画像をリサイズし、キーポイントは縦横の倍率をかけるだけで変換する
+    h, w = image.shape[:2]
+    resized = cv2.resize(image, dsize=(resize.width, resize.height), interpolation=resize.interpolation)
+    if image.ndim == 3 and resized.ndim == 2:
+        # cv2.resizeは1チャネルの場合にチャネル次元を落とすため戻す
+        resized = resized[..., None]
+    keypoints = keypoints * np.array([resize.width / w, resize.height / h], dtype=np.float64)
+    return resized, keypoints
+
+
 class RSNA2024KeypointDatasetTrain(Dataset):
     def __init__(
         self,
@@ -88,52 +115,57 @@ class RSNA2024KeypointDatasetTrain(Dataset):
         self._train_df = train_df.copy()
         self._phase = phase
         self._transform = transform
+        self._resize_only = None if phase == DatasetPhase.TRAIN else get_resize_only_transform(transform)
         self._heatmap_size = heatmap_size
         self._labels = {
             'spinal_canal': 0,
         }
+        self._label_indices = np.arange(len(self._labels), dtype=np.int64)
         self._stride = stride
 
+        self._radius = max(0, int(gaussian_radius([s // self._stride for s in self._heatmap_size])))
+        diameter = 2 * self._radius + 1
+        self._gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6).astype(np.float32)
+
+        self._study_ids = self._train_df['study_id'].to_numpy()
+        self._png_paths = self._train_df['png_path'].to_numpy()
+        self._keypoints = self._train_df[['x', 'y']].to_numpy(dtype=np.float64).reshape(-1, len(self._labels), 2)
+
     def __len__(self):
         return len(self._train_df)
 
     def _read_image(self, image_path: str) -> np.ndarray:
         image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        return image.astype(np.uint8)
+        return image
 
     def __getitem__(self, idx):
-        target_row = self._train_df.iloc[idx]
-        study_id = target_row['study_id']
-        image_path = target_row['png_path']
+        study_id = self._study_ids[idx]
+        image_path = self._png_paths[idx]
         image = self._read_image((self._image_root / image_path).as_posix())
 
-        keypoints = [[target_row['x'], target_row['y']]]
-        class_labels = ['spinal_canal']
+        keypoints = self._keypoints[idx]
+        class_labels = self._label_indices
 
-        if self._transform is not None:
+        if self._resize_only is not None:
+            image, keypoints = resize_with_keypoints(image, keypoints, self._resize_only)
+        elif self._transform is not None:
             transformed = self._transform(image=image, keypoints=keypoints, class_labels=class_labels)
             image = transformed['image']
-            keypoints = transformed['keypoints']
-            class_labels = transformed['class_labels']
+            keypoints = np.asarray(transformed['keypoints'], dtype=np.float64).reshape(-1, 2)
+            class_labels = np.asarray(transformed['class_labels'], dtype=np.int64)
 
         h, w = image.shape[:2]
-        heatmap = np.zeros([len(self._labels), h // self._stride, w // self._stride])
-        radius = gaussian_radius([s // self._stride for s in self._heatmap_size])
-        radius = max(0, int(radius))
-        for keypoint, class_label in zip(keypoints, class_labels):
-            index = self._labels[class_label]
-            kpt_x = keypoint[0] / self._stride
-            kpt_y = keypoint[1] / self._stride
-            draw_gaussian(heatmap[index], (kpt_x, kpt_y), radius)
-
-        image = image.astype(np.float32)
-        image = image[None, ...]
-
-        ret_keypoints = [(-1.0, -1.0) for _ in range(len(self._labels))]
-        for keypoint, class_label in zip(keypoints, class_labels):
-            index = self._labels[class_label]
-            ret_keypoints[index] = keypoint
-        return image, heatmap, study_id, np.asarray(ret_keypoints)
+        heatmap = np.zeros([len(self._labels), h // self._stride, w // self._stride], dtype=np.float32)
+        centers = (keypoints / self._stride).astype(np.int64)
+        draw_gaussians(heatmap, centers, class_labels, self._gaussian, self._radius)
+
+        if image.ndim == 2:
+            image = image[..., None]
+        image = torch.from_numpy(image)
+
+        ret_keypoints = np.full((len(self._labels), 2), -1.0)
+        ret_keypoints[class_labels] = keypoints
+        return image, torch.from_numpy(heatmap), torch.tensor(study_id, dtype=torch.int64), torch.from_numpy(ret_keypoints)
 
 
 if __name__ == '__main__':
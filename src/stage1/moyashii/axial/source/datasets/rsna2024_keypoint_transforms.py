@@ -20,11 +20,9 @@ def build_transforms(phase: DatasetPhase, image_size: tuple[int, int]) -> A.Comp
             A.ShiftScaleRotate(shift_limit=0.1, scale_limit=0.1, rotate_limit=8, border_mode=0, p=0.5),
             A.Resize(*image_size),
             A.CoarseDropout(max_holes=16, max_height=24, max_width=24, min_holes=1, min_height=8, min_width=8, p=0.5),
-            A.Normalize(mean=0.5, std=0.5)
         ], keypoint_params=A.KeypointParams(format='xy', label_fields=['class_labels'], remove_invisible=False))
     else:
         transforms = A.Compose([
             A.Resize(*image_size),
-            A.Normalize(mean=0.5, std=0.5)
         ], keypoint_params=A.KeypointParams(format='xy', label_fields=['class_labels'], remove_invisible=False))
     return transforms
@@ -3,6 +3,9 @@
 
 import math
 from typing import Optional
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import re
@@ -17,6 +20,7 @@ import torch
 from torch.utils.data import Dataset
 
 import albumentations as A
+from numba import njit
 
 import sys
 from pathlib import Path
@@ -49,31 +53,67 @@ def gaussian_radius(det_size, min_overlap=0.7):
 
 def gaussian2D(shape, sigma=1):
     m, n = [(ss - 1.) / 2. for ss in shape]
-    y, x = np.ogrid[-m:m+1, -n:n+1]
+    y, x = np.arange(-m, m + 1), np.arange(-n, n + 1)
 
-    h = np.exp(-(x * x + y * y) / (2 * sigma * sigma))
+    # 等方ガウシアンは分離可能なので、1次元ガウシアンの外積で計算する（expの評価回数を削減）
+    h = np.outer(np.exp(-(y * y) / (2 * sigma * sigma)), np.exp(-(x * x) / (2 * sigma * sigma)))
     h[h < np.finfo(h.dtype).eps * h.max()] = 0
     return h
 
 
-def draw_gaussian(heatmap, center, radius, k=1):
-    diameter = 2 * radius + 1
-    gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6)
+@njit(cache=True, fastmath=True)
+def _draw_gaussian_numba(heatmap2d, cx, cy, radius, gaussian, k):
+    # ヒートマップ内にクリップした窓を一度だけ走査し、スタンプとの最大値をin-placeで書き込む
+    height, width = heatmap2d.shape
+    for y in range(max(0, cy - radius), min(height, cy + radius + 1)):
+        for x in range(max(0, cx - radius), min(width, cx + radius + 1)):
+            v = gaussian[y - cy + radius, x - cx + radius] * k
+            if v > heatmap2d[y, x]:
+                heatmap2d[y, x] = v
 
-    x, y = round(center[0]), round(center[1])
 
-    height, width = heatmap.shape[0:2]
+# JITコンパイルをプロセス起動時に一度だけ済ませておく
+_draw_gaussian_numba(np.zeros((1, 1), dtype=np.float32), 0, 0, 0, np.ones((1, 1), dtype=np.float32), 1)
 
-    left, right = min(x, radius), min(width - x, radius + 1)
-    top, bottom = min(y, radius), min(height - y, radius + 1)
 
-    masked_heatmap = heatmap[y - top:y + bottom, x - left:x + right]
-    masked_gaussian = gaussian[radius - top:radius + bottom, radius - left:radius + right]
-    if min(masked_gaussian.shape) > 0 and min(masked_heatmap.shape) > 0:  # TODO debug
-        np.maximum(masked_heatmap, masked_gaussian * k, out=masked_heatmap)
+def draw_gaussians(heatmap, centers, indices, gaussian, radius, k=1):
+    # heatmap: (C, H, W), centers: (N, 2) の整数座標 (x, y), indices: (N,) の描画先チャネル
+    for index, (x, y) in zip(indices, centers):
+        _draw_gaussian_numba(heatmap[index], x, y, radius, gaussian, k)
     return heatmap
 
 
+def get_resize_only_transform(transform: Optional[A.Compose]) -> Optional[A.Resize]:
+    # transformがResizeのみで構成されている場合はそのResizeを返す（それ以外はNone）
+    if transform is None or transform.p < 1.0 or len(transform.transforms) != 1:
+        return None
+    resize = transform.transforms[0]
+    if not isinstance(resize, A.Resize) or resize.p < 1.0:
+        return None
+    return resize
+
+
+def resize_with_keypoints(image: np.ndarray, keypoints: np.ndarray, resize: A.Resize) -> tuple[np.ndarray, np.ndarray]:
+    # A.Resizeと同じ補間で画像をリサイズし、キーポイントは縦横の倍率をかけるだけで変換する
+    h, w = image.shape[:2]
+    resized = cv2.resize(image, dsize=(resize.width, resize.height), interpolation=resize.interpolation)
+    if image.ndim == 3 and resized.ndim == 2:
+        # cv2.resizeは1チャネルの場合にチャネル次元を落とすため戻す
+        resized = resized[..., None]
+    keypoints = keypoints * np.array([resize.width / w, resize.height / h], dtype=np.float64)
+    return resized, keypoints
+
+
+@lru_cache(maxsize=None)
+def load_series_index(image_dir: str) -> dict:
+    # series内のスライス一覧は不変なので、fold毎にDatasetを作り直しても再走査しないようにキャッシュする
+    image_paths = np.asarray(sorted(Path(image_dir).iterdir()))
+    inst_to_idx = {}
+    for i, image_path in enumerate(image_paths):
+        inst_to_idx.setdefault(int(image_path.stem.split('_')[1]), i)
+    return dict(paths=image_paths, inst_to_idx=inst_to_idx)
+
+
 class RSNA2024KeypointDatasetTrainV1(Dataset):
     def __init__(
         self,
@@ -88,6 +128,7 @@ class RSNA2024KeypointDatasetTrainV1(Dataset):
         self._train_df = train_df.copy()
         self._phase = phase
         self._transform = transform
+        self._resize_only = None if phase == DatasetPhase.TRAIN else get_resize_only_transform(transform)
         self._heatmap_size = heatmap_size
         self._labels = {
             'L1/L2': 0,
@@ -96,53 +137,53 @@ class RSNA2024KeypointDatasetTrainV1(Dataset):
             'L4/L5': 3,
             'L5/S1': 4,
         }
+        self._label_indices = np.arange(len(self._labels), dtype=np.int64)
         self._stride = stride
 
+        self._radius = max(0, int(gaussian_radius([s // self._stride for s in self._heatmap_size])))
+        diameter = 2 * self._radius + 1
+        self._gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6).astype(np.float32)
+
+        self._study_ids = self._train_df['study_id'].to_numpy()
+        self._png_paths = self._train_df['png_path'].to_numpy()
+        keypoint_columns = [f'{segment}_{axis}' for segment in self._labels for axis in ('x', 'y')]
+        self._keypoints = self._train_df[keypoint_columns].to_numpy(dtype=np.float64).reshape(-1, len(self._labels), 2)
+
     def __len__(self):
         return len(self._train_df)
 
     def _read_image(self, image_path: str) -> np.ndarray:
         image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        return image.astype(np.uint8)
+        return image
 
     def __getitem__(self, idx):
-        target_row = self._train_df.iloc[idx]
-        study_id = target_row['study_id']
-        image_path = target_row['png_path']
+        study_id = self._study_ids[idx]
+        image_path = self._png_paths[idx]
         image = self._read_image((self._image_root / image_path).as_posix())
 
-        keypoints = []
-        class_labels = []
-        for segment in ['L1/L2', 'L2/L3', 'L3/L4', 'L4/L5', 'L5/S1']:
-            seg_x = segment + '_x'
-            seg_y = segment + '_y'
-            keypoints.append((round(target_row[seg_x]), round(target_row[seg_y])))
-            class_labels.append(segment)
+        keypoints = np.round(self._keypoints[idx])
+        class_labels = self._label_indices
 
-        if self._transform is not None:
+        if self._resize_only is not None:
+            image, keypoints = resize_with_keypoints(image, keypoints, self._resize_only)
+        elif self._transform is not None:
             transformed = self._transform(image=image, keypoints=keypoints, class_labels=class_labels)
             image = transformed['image']
-            keypoints = transformed['keypoints']
-            class_labels = transformed['class_labels']
+            keypoints = np.asarray(transformed['keypoints'], dtype=np.float64).reshape(-1, 2)
+            class_labels = np.asarray(transformed['class_labels'], dtype=np.int64)
 
         h, w = image.shape[:2]
-        heatmap = np.zeros([len(self._labels), h // self._stride, w // self._stride])
-        radius = gaussian_radius([s // self._stride for s in self._heatmap_size])
-        radius = max(0, int(radius))
-        for keypoint, class_label in zip(keypoints, class_labels):
-            index = self._labels[class_label]
-            kpt_x = keypoint[0] / self._stride
-            kpt_y = keypoint[1] / self._stride
-            draw_gaussian(heatmap[index], (kpt_x, kpt_y), radius)
+        heatmap = np.zeros([len(self._labels), h // self._stride, w // self._stride], dtype=np.float32)
+        centers = np.round(keypoints / self._stride).astype(np.int64)
+        draw_gaussians(heatmap, centers, class_labels, self._gaussian, self._radius)
 
-        image = image.astype(np.float32)
-        image = image[None, ...]
+        if image.ndim == 2:
+            image = image[..., None]
+        image = torch.from_numpy(image)
 
-        ret_keypoints = [(-1.0, -1.0) for _ in range(len(self._labels))]
-        for keypoint, class_label in zip(keypoints, class_labels):
-            index = self._labels[class_label]
-            ret_keypoints[index] = keypoint
-        return image, heatmap, study_id, np.asarray(ret_keypoints)
+        ret_keypoints = np.full((len(self._labels), 2), -1.0)
+        ret_keypoints[class_labels] = keypoints
+        return image, torch.from_numpy(heatmap), torch.tensor(study_id, dtype=torch.int64), torch.from_numpy(ret_keypoints)
 
 
 class RSNA2024KeypointDatasetTrainV2(Dataset):
@@ -156,17 +197,25 @@ class RSNA2024KeypointDatasetTrainV2(Dataset):
         num_slices: int = 1,
         use_center: bool = False,
         stride: int = 4,
+        series_cache_dir: Optional[str] = None,
+        max_cached_series: int = 256,
     ) -> None:
         self._image_root = Path(image_root)
         self._train_df = train_df.copy()
         self._phase = phase
         self._transform = transform
+        self._resize_only = None if phase == DatasetPhase.TRAIN else get_resize_only_transform(transform)
         self._heatmap_size = heatmap_size
         self._num_slices = num_slices
         if self._num_slices % 2 == 0:
             raise ValueError('num_slices must be an odd number.')
         self._use_center = use_center
         self._stride = stride
+
+        # ガウシアンの半径とスタンプはheatmap_sizeとstrideのみに依存するため事前に計算しておく
+        self._radius = max(0, int(gaussian_radius([s // self._stride for s in self._heatmap_size])))
+        diameter = 2 * self._radius + 1
+        self._gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6).astype(np.float32)
         self._labels = {
             'L1/L2': 0,
             'L2/L3': 1,
@@ -174,52 +223,118 @@ class RSNA2024KeypointDatasetTrainV2(Dataset):
             'L4/L5': 3,
             'L5/S1': 4,
         }
+        self._label_indices = np.arange(len(self._labels), dtype=np.int64)
+
+        # tools/create_series_cache.py で作成したseries単位のnpyをmemmapで読み込む（存在しない場合はPNGを読み込む）
+        self._series_cache_dir = None if series_cache_dir is None else self._image_root / series_cache_dir
+        self._max_cached_series = max_cached_series
+        self._series_cache = OrderedDict()
+        self._image_size = (512, 512)
+
+        # キャッシュが無い場合はスライスのデコードをスレッドで並列化する（cv2はデコード中にGILを解放する）
+        # DataLoaderのworkerはforkで作られスレッドは引き継がれないため、プールはプロセス毎に遅延生成する
+        self._num_read_threads = min(self._num_slices, 4)
+        self._read_pool = None
+        self._read_pool_pid = None
+
+        # __getitem__でpandasの行参照を避けるため、必要な列を事前にnumpy配列へ変換しておく
+        self._study_ids = self._train_df['study_id'].to_numpy()
+        self._image_dirs = self._train_df['image_dir'].to_numpy()
+        self._instance_numbers = self._train_df['instance_number'].to_numpy()
+        norm_keypoint_columns = [f'{segment}_{axis}' for segment in self._labels for axis in ('nx', 'ny')]
+        self._norm_keypoints = self._train_df[norm_keypoint_columns].to_numpy(dtype=np.float64).reshape(-1, len(self._labels), 2)
+
+        # series内のスライス一覧とinstance_number→インデックスの対応は事前に作成しておく
+        self._dir_index = {
+            image_dir: load_series_index((self._image_root / image_dir).as_posix())
+            for image_dir in np.unique(self._image_dirs)
+        }
 
     def __len__(self):
         return len(self._train_df)
 
+    def _load_series(self, image_dir: str) -> Optional[np.ndarray]:
+        if self._series_cache_dir is None:
+            return None
+
+        if image_dir in self._series_cache:
+            self._series_cache.move_to_end(image_dir)
+            return self._series_cache[image_dir]
+
+        # memmapはファイルディスクリプタを保持するため、開いておくseries数に上限を設ける
+        study_id, series_id = Path(image_dir).parts[-2:]
+        cache_path = self._series_cache_dir / f'{study_id}_{series_id}.npy'
+        series = np.load(cache_path, mmap_mode='r') if cache_path.exists() else None
+        # PNGの一覧とスライス数・画像サイズが一致しないキャッシュ（古いデータセットや異なるimage_sizeで作成したもの）はPNGで代替する
+        width, height = self._image_size
+        if series is not None and series.shape != (len(self._dir_index[image_dir]['paths']), height, width):
+            series = None
+        self._series_cache[image_dir] = series
+        if len(self._series_cache) > self._max_cached_series:
+            self._series_cache.popitem(last=False)
+        return series
+
     def _read_image(self, image_path: str, image_size: Optional[tuple[int, int]] = (512, 512)) -> np.ndarray:
         image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
         if image_size is not None:
             image = cv2.resize(image, dsize=image_size, interpolation=cv2.INTER_LINEAR)
-        return image.astype(np.uint8)
+        return image
+
+    def __del__(self):
+        self._close_read_pool()
+
+    def __getstate__(self):
+        # spawnでworkerへ渡す際にスレッドプールはpickleできないため除外する
+        state = self.__dict__.copy()
+        state['_read_pool'] = None
+        state['_read_pool_pid'] = None
+        return state
+
+    def _close_read_pool(self):
+        if getattr(self, '_read_pool', None) is not None:
+            self._read_pool.shutdown(wait=False)
+        self._read_pool = None
+        self._read_pool_pid = None
+
+    def _read_images(self, image_paths: np.ndarray) -> list[np.ndarray]:
+        if self._num_read_threads <= 1:
+            return [self._read_image(image_path.as_posix(), self._image_size) for image_path in image_paths]
+
+        if self._read_pool is None or self._read_pool_pid != os.getpid():
+            # fork前に作成されたプールは閉じてから作り直す
+            self._close_read_pool()
+            self._read_pool = ThreadPoolExecutor(self._num_read_threads)
+            self._read_pool_pid = os.getpid()
+        return list(self._read_pool.map(lambda image_path: self._read_image(image_path.as_posix(), self._image_size), image_paths))
 
     def _select_n_elements(self, lst: np.ndarray, n: int, base_index: int) -> np.ndarray:
         length = len(lst)
 
         # 基準位置からn個のインデックスを生成
         offset = n // 2
-        indices = np.linspace(base_index - offset, base_index + offset, n).astype(int)
+        # nは奇数のため、linspaceを使わずに整数の連番で生成できる
+        indices = np.arange(base_index - offset, base_index + offset + 1)
 
         # インデックスを 0 以上、length-1 以下にクリップ
-        indices = np.clip(indices, 0, length - 1)
+        np.clip(indices, 0, length - 1, out=indices)
 
         # 対応する要素を返す
         return lst[indices]
 
     def __getitem__(self, idx):
-        target_row = self._train_df.iloc[idx]
-        study_id = target_row['study_id']
-
-        image_dir = self._image_root / target_row['image_dir']
-        image_paths = np.asarray(sorted(image_dir.iterdir()))
-        base_index = -1
-        base_instance_number = target_row['instance_number']
-        for i, image_path in enumerate(image_paths):
-            instance_number = int(image_path.stem.split('_')[1])
-            if instance_number == base_instance_number:
-                base_index = i
-                break
+        study_id = self._study_ids[idx]
+        image_dir = self._image_dirs[idx]
+
+        dir_index = self._dir_index[image_dir]
+        image_paths = dir_index['paths']
+        base_instance_number = self._instance_numbers[idx]
+        base_index = dir_index['inst_to_idx'].get(base_instance_number, -1)
         assert base_index != -1, f'base_index is not found. study_id: {study_id}, base_instance_number: {base_instance_number}'
 
         # 正規化したキーポイント座標とラベルを取得
-        norm_keypoints = []
-        class_labels = []
-        for segment in ['L1/L2', 'L2/L3', 'L3/L4', 'L4/L5', 'L5/S1']:
-            seg_x = segment + '_nx'
-            seg_y = segment + '_ny'
-            norm_keypoints.append((target_row[seg_x], target_row[seg_y]))
-            class_labels.append(segment)
+        norm_keypoints = self._norm_keypoints[idx]
+        # キーポイントは_labelsの順に並んでいるため、ラベル名ではなくインデックスをそのまま渡す
+        class_labels = self._label_indices
 
         if self._use_center:
             # 中心スライスを基準にデータを収集する
@@ -229,49 +344,40 @@ class RSNA2024KeypointDatasetTrainV2(Dataset):
             base_index = base_index
 
         # 基準スライスを起点にnスライスを選択
-        image_paths = self._select_n_elements(image_paths, self._num_slices, base_index)
+        indices = self._select_n_elements(np.arange(len(image_paths)), self._num_slices, base_index)
 
-        # 同一series内に異なる解像度のスライスが含まれるケースがあるため、読み込み時に固定サイズにリサイズする
-        images = []
-        for image_path in image_paths:
-            image = self._read_image(image_path.as_posix())
-            images.append(image)
-        image = np.stack(images, axis=-1)
+        series = self._load_series(image_dir)
+        if series is not None:
+            # 固定サイズにリサイズ済みのスライスをmemmapから読み込む
+            image = np.ascontiguousarray(series[indices].transpose(1, 2, 0))
+        else:
+            # 同一series内に異なる解像度のスライスが含まれるケースがあるため、読み込み時に固定サイズにリサイズする
+            images = self._read_images(image_paths[indices])
+            image = np.stack(images, axis=-1)
 
         # 正規化キーポイント座標を画像サイズキーポイントに変換
-        keypoints = []
         h, w = image.shape[:2]
-        for norm_keypoint in norm_keypoints:
-            nx, ny = norm_keypoint
-            x, y = nx * w, ny * h
-            keypoints.append((x, y))
+        keypoints = norm_keypoints * np.array([w, h], dtype=np.float64)
 
         # データ拡張
-        if self._transform is not None:
+        if self._resize_only is not None:
+            image, keypoints = resize_with_keypoints(image, keypoints, self._resize_only)
+        elif self._transform is not None:
             transformed = self._transform(image=image, keypoints=keypoints, class_labels=class_labels)
             image = transformed['image']
-            keypoints = transformed['keypoints']
-            class_labels = transformed['class_labels']
+            keypoints = np.asarray(transformed['keypoints'], dtype=np.float64).reshape(-1, 2)
+            class_labels = np.asarray(transformed['class_labels'], dtype=np.int64)
 
         # ヒートマップのGTを作成
         h, w = image.shape[:2]
-        heatmap = np.zeros([len(self._labels), h // self._stride, w // self._stride])
-        radius = gaussian_radius([s // self._stride for s in self._heatmap_size])
-        radius = max(0, int(radius))
-        for keypoint, class_label in zip(keypoints, class_labels):
-            index = self._labels[class_label]
-            kpt_x = keypoint[0] / self._stride
-            kpt_y = keypoint[1] / self._stride
-            draw_gaussian(heatmap[index], (kpt_x, kpt_y), radius)
-
-        image = image.astype(np.float32)
-        if len(image.shape) == 2:
-            image = image[None, ...]
-        else:
-            image = image.transpose(2, 0, 1)
+        heatmap = np.zeros([len(self._labels), h // self._stride, w // self._stride], dtype=np.float32)
+        centers = np.round(keypoints / self._stride).astype(np.int64)
+        draw_gaussians(heatmap, centers, class_labels, self._gaussian, self._radius)
+
+        if image.ndim == 2:
+            image = image[..., None]
+        image = torch.from_numpy(image)
 
-        ret_keypoints = [(-1.0, -1.0) for _ in range(len(self._labels))]
-        for keypoint, class_label in zip(keypoints, class_labels):
-            index = self._labels[class_label]
-            ret_keypoints[index] = keypoint
-        return image, heatmap, study_id, np.asarray(ret_keypoints)
+        ret_keypoints = np.full((len(self._labels), 2), -1.0)
+        ret_keypoints[class_labels] = keypoints
+        return image, torch.from_numpy(heatmap), torch.tensor(study_id, dtype=torch.int64), torch.from_numpy(ret_keypoints)
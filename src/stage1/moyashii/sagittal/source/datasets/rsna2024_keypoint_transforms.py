@@ -57,7 +57,6 @@ def build_transforms(
             A.ShiftScaleRotate(**shift_scale_rotate_params),
             A.Resize(*image_size),
             A.CoarseDropout(**coarse_dropout_params),
-            A.Normalize(mean=0.5, std=0.5)
         ])
 
         transforms = A.Compose(
@@ -67,7 +66,6 @@ def build_transforms(
     else:
         transforms = A.Compose([
             A.Resize(*image_size),
-            A.Normalize(mean=0.5, std=0.5)
         ], keypoint_params=A.KeypointParams(format='xy', label_fields=['class_labels'], remove_invisible=False))
     print(transforms)
     return transforms
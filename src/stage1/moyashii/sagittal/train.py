@@ -24,6 +24,13 @@ from source.utils.config import get_config
 from src.utils import load_settings
 
 
+def to_model_input(images: torch.Tensor, device: torch.device) -> torch.Tensor:
+    # uint8 (B, H, W, C) をGPUへ転送してからfloat化し、Normalize(mean=0.5, std=0.5)相当の正規化を行う
+    # permuteのみでcontiguousにしないため、channels_lastのメモリレイアウトのままモデルへ入力される
+    images = images.to(device, non_blocking=True).permute(0, 3, 1, 2)
+    return images.float().div_(127.5).sub_(1.0)
+
+
 def train_one_epoch(
     epoch: int,
     model: torch.nn.Module,
@@ -40,8 +47,8 @@ def train_one_epoch(
         optimizer.zero_grad()
         for idx, batch in enumerate(pbar):
             images, targets, study_id, keypoints = batch
-            images = images.to(device)
-            targets = targets.to(device)
+            images = to_model_input(images, device)
+            targets = targets.to(device, non_blocking=True)
 
             with autocast:
                 outputs = model(images, targets)
@@ -96,8 +103,8 @@ def validation_one_epoch(
         with torch.no_grad():
             for idx, batch in enumerate(pbar):
                 images, targets, study_id, keypoints = batch
-                images = images.to(device)
-                targets = targets.to(device)
+                images = to_model_input(images, device)
+                targets = targets.to(device, non_blocking=True)
 
                 with autocast:
                     outputs = model(images, targets, force_loss_execute=True)
@@ -180,10 +187,14 @@ def main(args: argparse.Namespace):
                                       train_df=fold_valid_df,
                                       phase=DatasetPhase.VALIDATION,
                                       transform=valid_transform,)
-        train_dataloader = DataLoader(train_dataset, batch_size=config['dataloader']['batch_size'], num_workers=config['dataloader']['num_workers'],
-                                      shuffle=True, pin_memory=True, drop_last=True)
-        valid_dataloader = DataLoader(valid_dataset, batch_size=config['dataloader']['batch_size'], num_workers=config['dataloader']['num_workers'],
-                                      shuffle=False, pin_memory=True, drop_last=False)
+        # workerをエポック間で使い回し、fork時のDataset複製やキャッシュの作り直しを避ける
+        num_workers = config['dataloader']['num_workers']
+        loader_kwargs = dict(num_workers=num_workers, pin_memory=True, persistent_workers=num_workers > 0,
+                             prefetch_factor=2 if num_workers > 0 else None)
+        train_dataloader = DataLoader(train_dataset, batch_size=config['dataloader']['batch_size'],
+                                      shuffle=True, drop_last=True, **loader_kwargs)
+        valid_dataloader = DataLoader(valid_dataset, batch_size=config['dataloader']['batch_size'],
+                                      shuffle=False, drop_last=False, **loader_kwargs)
 
         # model
         model = RSNA2024KeypointNet(**config['model'])
@@ -0,0 +1,53 @@
+# %% [markdown]
+# # Import Libralies
+
+# %%
+import os
+import argparse
+
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+from src.utils import load_settings
+
+# %% [markdown]
+# # Configs
+
+# %%
+parser = argparse.ArgumentParser()
+parser.add_argument('user', type=str)
+parser.add_argument('version', type=str, help='keypoint dataset version (e.g. v6)')
+parser.add_argument('--image_size', type=int, nargs=2, default=[512, 512],
+                    help='Must match the image_size used by RSNA2024KeypointDatasetTrainV2._read_image.')
+args = parser.parse_args()
+
+SETTINGS = load_settings()
+DATASET_DIR = SETTINGS.train_data_clean_dir / f'{args.user}/keypoint_datasets/{args.version}'
+SRC_DIR = DATASET_DIR / 'train_images_png'
+DST_DIR = DATASET_DIR / 'train_images_npy'
+DST_DIR.mkdir(exist_ok=True, parents=True)
+
+# %% [markdown]
+# # Create series cache
+# series内のスライスを固定サイズにリサイズし、{study_id}_{series_id}.npy (num_slices, H, W) uint8 として保存する
+# 学習時はmemmapで読み込むことで、エポックごとのPNGデコードを省略する
+# 使用例: sagittal/train.py ... --options dataset.series_cache_dir=train_images_npy
+
+# %%
+image_dirs = sorted(p for p in SRC_DIR.glob('*/*') if p.is_dir())
+for image_dir in tqdm(image_dirs):
+    study_id, series_id = image_dir.parent.name, image_dir.name
+    image_paths = sorted(image_dir.iterdir())
+
+    dst_path = DST_DIR / f'{study_id}_{series_id}.npy'
+    # 途中で中断された場合に未書き込み（ゼロ埋め）のnpyが残らないよう、一時ファイルに書き込んでから置き換える
+    tmp_path = DST_DIR / f'{study_id}_{series_id}.npy.tmp'
+    series = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(image_paths), args.image_size[1], args.image_size[0]))
+    for i, image_path in enumerate(image_paths):
+        image = cv2.imread(image_path.as_posix(), cv2.IMREAD_GRAYSCALE)
+        series[i] = cv2.resize(image, dsize=tuple(args.image_size), interpolation=cv2.INTER_LINEAR)
+    series.flush()
+    del series
+    os.replace(tmp_path, dst_path)
@@ -93,17 +93,15 @@ class FocalLoss(nn.Module):
                 'Reduction must be one of: "mean", "sum", "none".')
 
         super().__init__()
-        self.alpha = alpha
+        # bufferとして登録し、model.to(device)でalphaも一緒に転送されるようにする
+        self.register_buffer('alpha', alpha, persistent=False)
         self.gamma = gamma
         self.ignore_index = ignore_index
         self.reduction = reduction
 
-        self.nll_loss = nn.NLLLoss(
-            weight=alpha, reduction='none', ignore_index=ignore_index)
-
     def __repr__(self):
         arg_keys = ['alpha', 'gamma', 'ignore_index', 'reduction']
-        arg_vals = [self.__dict__[k] for k in arg_keys]
+        arg_vals = [getattr(self, k) for k in arg_keys]
         arg_strs = [f'{k}={v!r}' for k, v in zip(arg_keys, arg_vals)]
         arg_str = ', '.join(arg_strs)
         return f'{type(self).__name__}({arg_str})'
@@ -116,20 +114,15 @@ class FocalLoss(nn.Module):
             # (N, d1, d2, ..., dK) --> (N * d1 * ... * dK,)
             y = y.view(-1)
 
-        unignored_mask = y != self.ignore_index
-        y = y[unignored_mask]
-        if len(y) == 0:
-            return torch.tensor(0.)
-        x = x[unignored_mask]
-
         # compute weighted cross entropy term: -alpha * log(pt)
-        # (alpha is already part of self.nll_loss)
-        log_p = F.log_softmax(x, dim=-1)
-        ce = self.nll_loss(log_p, y)
+        # (ignored labels get a loss of 0 and stay in place)
+        ce = F.cross_entropy(x, y, weight=self.alpha, ignore_index=self.ignore_index, reduction='none')
 
-        # get true class column from each row
-        all_rows = torch.arange(len(x))
-        log_pt = log_p[all_rows, y]
+        # get log(pt) of the true class (without alpha)
+        if self.alpha is None:
+            log_pt = -ce
+        else:
+            log_pt = -F.cross_entropy(x, y, ignore_index=self.ignore_index, reduction='none')
 
         # compute focal term: (1 - pt)^gamma
         pt = log_pt.exp()
@@ -139,7 +132,8 @@ class FocalLoss(nn.Module):
         loss = focal_term * ce
 
         if self.reduction == 'mean':
-            loss = loss.mean()
+            # average over the unignored labels
+            loss = loss.sum() / (y != self.ignore_index).sum().clamp(min=1)
         elif self.reduction == 'sum':
             loss = loss.sum()
 
@@ -155,8 +149,10 @@ class HierarchicalCrossEntropyLoss(nn.Module):
             [1.0, 1.0, 1.0],  # 中度
             [2.0, 1.0, 1.0],  # 重度
         ],
+        reduction: str = 'mean',
     ):
         super().__init__()
+        self.reduction = reduction
         if weight is not None:
             self.register_buffer('class_weights', torch.Tensor(weight))
         else:
@@ -180,7 +176,9 @@ class HierarchicalCrossEntropyLoss(nn.Module):
         # 距離に基づいたペナルティを損失に加える
         loss = ce_loss * distances
 
-        return loss.mean()
+        if self.reduction == 'mean':
+            loss = loss.mean()
+        return loss
 
 
 class RSNA2024Loss(nn.Module):
@@ -202,17 +200,17 @@ class RSNA2024Loss(nn.Module):
         self.overall_loss_weight = overall_loss_weight
         self.level_loss_weight = level_loss_weight
         self.slice_loss_weight = slice_loss_weight
-        self.level_loss = nn.CrossEntropyLoss()
+        self.level_loss = nn.CrossEntropyLoss(reduction='none')
 
         ce_loss_work = ce_loss.copy()
         ce_loss_name = ce_loss_work.pop('name')
         if ce_loss_name == 'CrossEntropyLoss':
             if 'weight' in ce_loss_work:
                 weight = ce_loss_work.pop('weight')
-                ce_loss_work['weight'] = torch.tensor(weight)
-            self.ce_loss = nn.CrossEntropyLoss(**ce_loss_work)
+                ce_loss_work['weight'] = torch.tensor(weight, dtype=torch.float32)
+            self.ce_loss = nn.CrossEntropyLoss(**ce_loss_work, reduction='none')
         elif ce_loss_name == 'HierarchicalCrossEntropyLoss':
-            self.ce_loss = HierarchicalCrossEntropyLoss(**ce_loss_work)
+            self.ce_loss = HierarchicalCrossEntropyLoss(**ce_loss_work, reduction='none')
         else:
             raise ValueError(f'{ce_loss_name} is not supported.')
 
@@ -221,7 +219,7 @@ class RSNA2024Loss(nn.Module):
         if slice_ce_loss_name == 'CrossEntropyLoss':
             if 'weight' in slice_ce_loss_work:
                 weight = slice_ce_loss_work.pop('weight')
-                slice_ce_loss_work['weight'] = torch.tensor(weight)
+                slice_ce_loss_work['weight'] = torch.tensor(weight, dtype=torch.float32)
             self.slice_ce_loss = nn.CrossEntropyLoss(**slice_ce_loss_work, reduction='none')
         else:
             raise ValueError(f'{slice_ce_loss_name} is not supported.')
@@ -242,36 +240,62 @@ class RSNA2024Loss(nn.Module):
     ) -> dict[str, torch.Tensor]:
         losses = dict()
 
-        partial_losses = []
-        for cond_idx, cond in enumerate(self.conditions):
-            for level_idx, level in enumerate(self.levels):
-                logit = logits[:, cond_idx, level_idx]
-                target = targets[:, cond_idx, level_idx]
-                if torch.any(target != -100):
-                    partial_loss = self.ce_loss(logit, target) * self.condition_weight[cond_idx]
-                    partial_losses.append(partial_loss)
-
-        overall_loss = torch.mean(torch.stack(partial_losses)) * self.overall_loss_weight
-        losses['overall_loss'] = overall_loss.item()
+        # 疾患×部位をまとめて1回で損失を計算する
+        # (batch_size, num_conditions, num_levels, num_classes) -> (batch_size * num_conditions * num_levels, num_classes)
+        bs, num_conditions, num_levels, num_classes = logits.shape
+        if targets.ndim == logits.ndim:
+            # ソフトラベル: 疾患×部位ごとにバッチ数で平均を取る
+            partial_losses = self.ce_loss(logits.reshape(-1, num_classes), targets.reshape(-1, num_classes))
+            partial_losses = partial_losses.view(bs, num_conditions, num_levels)
+            available = torch.any(targets != -100, dim=-1)
+            normalizer = torch.ones_like(partial_losses)
+        else:
+            # ハードラベル: 疾患×部位ごとに無視ラベルを除いたサンプル数（クラス重みがあれば重みの和）で平均を取る
+            partial_losses = self.ce_loss(logits.reshape(-1, num_classes), targets.reshape(-1))
+            partial_losses = partial_losses.view(bs, num_conditions, num_levels)
+            available = targets != -100
+            normalizer = available.to(partial_losses.dtype)
+            if self.ce_loss.weight is not None:
+                normalizer = normalizer * self.ce_loss.weight[targets.clamp(min=0)]
+
+        # 教師ラベルが1つも存在しない疾患×部位は除外する
+        available = torch.any(available, dim=0)
+        normalizer = normalizer.sum(dim=0)
+        normalizer = torch.where(available, normalizer, torch.ones_like(normalizer))
+        partial_losses = partial_losses.sum(dim=0) / normalizer * self.condition_weight.view(-1, 1)
+        partial_losses = torch.where(available, partial_losses, torch.zeros_like(partial_losses))
+
+        overall_loss = partial_losses.sum() / available.sum() * self.overall_loss_weight
+        losses['overall_loss'] = overall_loss.detach()
 
         # level loss
         if self.level_loss_weight > 0.0:
-            level_losses = []
-            for level_idx, level in enumerate(self.levels):
-                level_logit = level_logits[:, level_idx]
-                level_target = level_targets[:, level_idx]
-                if torch.any(level_target != -100):
-                    level_loss = self.level_loss(level_logit, level_target)
-                    level_losses.append(level_loss)
-
-            level_loss = torch.mean(torch.stack(level_losses)) * self.level_loss_weight
-            losses['level_loss'] = level_loss.item()
+            # 部位をまとめて1回で損失を計算する
+            # (batch_size, num_levels, num_classes) -> (batch_size * num_levels, num_classes)
+            bs, num_levels, num_level_classes = level_logits.shape
+            if level_targets.ndim == level_logits.ndim:
+                # ソフトラベル: 部位ごとにバッチ数で平均を取る
+                level_losses = self.level_loss(level_logits.reshape(-1, num_level_classes), level_targets.reshape(-1, num_level_classes))
+                level_available = torch.any(level_targets != -100, dim=-1)
+                level_normalizer = torch.ones_like(level_losses).view(bs, num_levels)
+            else:
+                # ハードラベル: 部位ごとに無視ラベルを除いたサンプル数で平均を取る
+                level_losses = self.level_loss(level_logits.reshape(-1, num_level_classes), level_targets.reshape(-1))
+                level_available = level_targets != -100
+                level_normalizer = level_available.to(level_losses.dtype)
+            level_losses = level_losses.view(bs, num_levels).sum(dim=0) / level_normalizer.sum(dim=0).clamp(min=1)
+
+            # 教師ラベルが1つも存在しない部位は除外する
+            level_available = torch.any(level_available, dim=0)
+            level_losses = torch.where(level_available, level_losses, torch.zeros_like(level_losses))
+            level_loss = level_losses.sum() / level_available.sum().clamp(min=1) * self.level_loss_weight
+            losses['level_loss'] = level_loss.detach()
         else:
             level_loss = 0.0
             losses['level_loss'] = 0.0
 
         # slice loss
-        if slice_logits is not None and self.slice_loss_weight > 0.0 and slice_weights.sum() > 0:
+        if slice_logits is not None and self.slice_loss_weight > 0.0:
             bs, num_slices, num_condition, num_classes = slice_logits.shape
             slice_loss = self.slice_ce_loss(slice_logits.view(-1, num_classes), slice_labels.view(-1, num_classes))
             slice_loss = slice_loss.view(bs, num_slices, num_condition)
@@ -282,10 +306,10 @@ class RSNA2024Loss(nn.Module):
             # 疾患ごとの重みを適用する
             slice_loss = slice_loss * self.condition_weight.view(1, 1, -1)
 
-            # 教師ラベルが与えられた数で平均を取る
-            slice_loss = slice_loss.sum() / slice_weights.sum()
+            # 教師ラベルが与えられた数で平均を取る（教師ラベルが1つも無い場合は0になる）
+            slice_loss = slice_loss.sum() / slice_weights.sum().clamp(min=1)
             slice_loss = slice_loss * self.slice_loss_weight
-            losses['slice_loss'] = slice_loss.item()
+            losses['slice_loss'] = slice_loss.detach()
         else:
             slice_loss = 0.0
             losses['slice_loss'] = 0.0
@@ -1,6 +1,7 @@
 from typing import Optional
 
 import sys
+import math
 import ast
 import copy
 from pathlib import Path
@@ -80,14 +81,10 @@ def train_one_epoch(
             with autocast:
                 outputs = model(sagittal_t1_image, sagittal_t2_image, axial_t2_image, labels, slice_labels, slice_weights, level_labels)
                 loss = outputs['losses']['loss']
-                total_loss += loss.item()
+                total_loss += loss.detach()
                 total_overall_loss += outputs['losses']['overall_loss']
                 total_level_loss += outputs['losses']['level_loss']
 
-            if not torch.isfinite(loss):
-                print(f"Loss is {loss}, stopping training")
-                sys.exit(1)
-
             scaler.scale(loss).backward()
 
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1e9)
@@ -96,9 +93,16 @@ def train_one_epoch(
             scaler.update()
             optimizer.zero_grad()
 
+            # ステップ途中で同期しないよう、lossの値はstep後に1回だけ取得する
+            # (nan/infの場合はここで終了するため、そのステップで更新された重みが保存されることはない)
+            loss_value = loss.item()
+            if not math.isfinite(loss_value):
+                print(f"Loss is {loss_value}, stopping training")
+                sys.exit(1)
+
             pbar.set_postfix(
                 OrderedDict(
-                    loss=f'{loss.item():.6f}',
+                    loss=f'{loss_value:.6f}',
                     lr=f'{optimizer.param_groups[0]["lr"]:.3e}'
                 )
             )
@@ -107,9 +111,9 @@ def train_one_epoch(
                 scheduler.step()
 
     # loss
-    loss = total_loss / len(train_dataloader)
-    overall_loss = total_overall_loss / len(train_dataloader)
-    level_loss = total_level_loss / len(train_dataloader)
+    loss = float(total_loss) / len(train_dataloader)
+    overall_loss = float(total_overall_loss) / len(train_dataloader)
+    level_loss = float(total_level_loss) / len(train_dataloader)
 
     return dict(
         train_loss=loss,
@@ -175,9 +179,9 @@ def validation_one_epoch(
 
     # loss
     loss = total_loss / len(valid_dataloader)
-    overall_loss = total_overall_loss / len(valid_dataloader)
-    slice_loss = total_slice_loss / len(valid_dataloader)
-    level_loss = total_level_loss / len(valid_dataloader)
+    overall_loss = float(total_overall_loss) / len(valid_dataloader)
+    slice_loss = float(total_slice_loss) / len(valid_dataloader)
+    level_loss = float(total_level_loss) / len(valid_dataloader)
 
     # metrics
     logits = torch.cat(logits, dim=0)
@@ -93,17 +93,15 @@ class FocalLoss(nn.Module):
                 'Reduction must be one of: "mean", "sum", "none".')
 
         super().__init__()
-        self.alpha = alpha
+        # bufferとして登録し、model.to(device)でalphaも一緒に転送されるようにする
+        self.register_buffer('alpha', alpha, persistent=False)
         self.gamma = gamma
         self.ignore_index = ignore_index
         self.reduction = reduction
 
-        self.nll_loss = nn.NLLLoss(
-            weight=alpha, reduction='none', ignore_index=ignore_index)
-
     def __repr__(self):
         arg_keys = ['alpha', 'gamma', 'ignore_index', 'reduction']
-        arg_vals = [self.__dict__[k] for k in arg_keys]
+        arg_vals = [getattr(self, k) for k in arg_keys]
         arg_strs = [f'{k}={v!r}' for k, v in zip(arg_keys, arg_vals)]
         arg_str = ', '.join(arg_strs)
         return f'{type(self).__name__}({arg_str})'
@@ -116,20 +114,15 @@ class FocalLoss(nn.Module):
             # (N, d1, d2, ..., dK) --> (N * d1 * ... * dK,)
             y = y.view(-1)
 
-        unignored_mask = y != self.ignore_index
-        y = y[unignored_mask]
-        if len(y) == 0:
-            return torch.tensor(0.)
-        x = x[unignored_mask]
-
         # compute weighted cross entropy term: -alpha * log(pt)
-        # (alpha is already part of self.nll_loss)
-        log_p = F.log_softmax(x, dim=-1)
-        ce = self.nll_loss(log_p, y)
+        # (ignored labels get a loss of 0 and stay in place)
+        ce = F.cross_entropy(x, y, weight=self.alpha, ignore_index=self.ignore_index, reduction='none')
 
-        # get true class column from each row
-        all_rows = torch.arange(len(x))
-        log_pt = log_p[all_rows, y]
+        # get log(pt) of the true class (without alpha)
+        if self.alpha is None:
+            log_pt = -ce
+        else:
+            log_pt = -F.cross_entropy(x, y, ignore_index=self.ignore_index, reduction='none')
 
         # compute focal term: (1 - pt)^gamma
         pt = log_pt.exp()
@@ -139,7 +132,8 @@ class FocalLoss(nn.Module):
         loss = focal_term * ce
 
         if self.reduction == 'mean':
-            loss = loss.mean()
+            # average over the unignored labels
+            loss = loss.sum() / (y != self.ignore_index).sum().clamp(min=1)
         elif self.reduction == 'sum':
             loss = loss.sum()
 
@@ -162,25 +156,25 @@ class RSNA2024Loss(nn.Module):
         self.levels = levels
         self.overall_loss_weight = overall_loss_weight
         self.level_loss_weight = level_loss_weight
-        self.level_loss = nn.CrossEntropyLoss()
+        self.level_loss = nn.CrossEntropyLoss(reduction='none')
 
         ce_loss_name = ce_loss.pop('name')
         if ce_loss_name == 'CrossEntropyLoss':
             if 'weight' in ce_loss:
                 weight = ce_loss.pop('weight')
-                ce_loss['weight'] = torch.tensor(weight)
-            self.ce_loss = nn.CrossEntropyLoss(**ce_loss)
+                ce_loss['weight'] = torch.tensor(weight, dtype=torch.float32)
+            self.ce_loss = nn.CrossEntropyLoss(**ce_loss, reduction='none')
         elif ce_loss_name == 'FocalLoss':
             if 'alpha' in ce_loss:
                 alpha = ce_loss.pop('alpha')
-                ce_loss['alpha'] = torch.tensor(alpha)
-            self.ce_loss = FocalLoss(**ce_loss)
+                ce_loss['alpha'] = torch.tensor(alpha, dtype=torch.float32)
+            self.ce_loss = FocalLoss(**ce_loss, reduction='none')
         else:
             raise ValueError(f'{ce_loss_name} is not supported.')
 
         if condition_weight is None:
             condition_weight = [1.0] * len(conditions)
-        self.condition_weight = condition_weight
+        self.register_buffer('condition_weight', torch.tensor(condition_weight), persistent=False)
 
     def forward(
         self,
@@ -190,29 +184,51 @@ class RSNA2024Loss(nn.Module):
         level_targets: Optional[torch.Tensor] = None,
     ) -> dict[str, torch.Tensor]:
         losses = dict()
-        partial_losses = []
-        for cond_idx, cond in enumerate(self.conditions):
-            for level_idx, level in enumerate(self.levels):
-                logit = logits[:, cond_idx, level_idx]
-                target = targets[:, cond_idx, level_idx]
-                partial_loss = self.ce_loss(logit, target) * self.condition_weight[cond_idx]
-                partial_losses.append(partial_loss)
-
-        overall_loss = torch.mean(torch.stack(partial_losses))
-        losses['overall_loss'] = overall_loss.item()
+        # 疾患×部位をまとめて1回で損失を計算する
+        # (batch_size, num_conditions, num_levels, num_classes) -> (batch_size * num_conditions * num_levels, num_classes)
+        bs, num_conditions, num_levels, num_classes = logits.shape
+        if targets.ndim == logits.ndim:
+            # ソフトラベル: 疾患×部位ごとにバッチ数で平均を取る
+            partial_losses = self.ce_loss(logits.reshape(-1, num_classes), targets.reshape(-1, num_classes))
+            normalizer = torch.ones_like(partial_losses)
+        else:
+            # ハードラベル: 疾患×部位ごとに無視ラベルを除いたサンプル数（クラス重みがあれば重みの和）で平均を取る
+            flat_targets = targets.reshape(-1)
+            available = flat_targets != self.ce_loss.ignore_index
+            partial_losses = self.ce_loss(logits.reshape(-1, num_classes), flat_targets)
+            normalizer = available.to(partial_losses.dtype)
+            if isinstance(self.ce_loss, nn.CrossEntropyLoss) and self.ce_loss.weight is not None:
+                normalizer = normalizer * self.ce_loss.weight[flat_targets.clamp(min=0)]
+        partial_losses = partial_losses.view(bs, num_conditions, num_levels).sum(dim=0)
+        normalizer = normalizer.view(bs, num_conditions, num_levels).sum(dim=0)
+        normalizer = torch.where(normalizer > 0, normalizer, torch.ones_like(normalizer))
+        partial_losses = partial_losses / normalizer * self.condition_weight.view(-1, 1)
+
+        overall_loss = torch.mean(partial_losses)
+        losses['overall_loss'] = overall_loss.detach()
 
         # level loss
         if self.level_loss_weight > 0.0:
-            level_losses = []
-            for level_idx, level in enumerate(self.levels):
-                level_logit = level_logits[:, level_idx]
-                level_target = level_targets[:, level_idx]
-                if torch.any(level_target != -100):
-                    level_loss = self.level_loss(level_logit, level_target)
-                    level_losses.append(level_loss)
-
-            level_loss = torch.mean(torch.stack(level_losses))
-            losses['level_loss'] = level_loss.item()
+            # 部位をまとめて1回で損失を計算する
+            # (batch_size, num_levels, num_classes) -> (batch_size * num_levels, num_classes)
+            bs, num_levels, num_level_classes = level_logits.shape
+            if level_targets.ndim == level_logits.ndim:
+                # ソフトラベル: 部位ごとにバッチ数で平均を取る
+                level_losses = self.level_loss(level_logits.reshape(-1, num_level_classes), level_targets.reshape(-1, num_level_classes))
+                level_available = torch.any(level_targets != -100, dim=-1)
+                level_normalizer = torch.ones_like(level_losses).view(bs, num_levels)
+            else:
+                # ハードラベル: 部位ごとに無視ラベルを除いたサンプル数で平均を取る
+                level_losses = self.level_loss(level_logits.reshape(-1, num_level_classes), level_targets.reshape(-1))
+                level_available = level_targets != -100
+                level_normalizer = level_available.to(level_losses.dtype)
+            level_losses = level_losses.view(bs, num_levels).sum(dim=0) / level_normalizer.sum(dim=0).clamp(min=1)
+
+            # 教師ラベルが1つも存在しない部位は除外する
+            level_available = torch.any(level_available, dim=0)
+            level_losses = torch.where(level_available, level_losses, torch.zeros_like(level_losses))
+            level_loss = level_losses.sum() / level_available.sum().clamp(min=1)
+            losses['level_loss'] = level_loss.detach()
         else:
             level_loss = 0.0
             losses['level_loss'] = 0.0
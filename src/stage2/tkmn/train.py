@@ -1,4 +1,5 @@
 import sys
+import math
 import copy
 from pathlib import Path
 import argparse
@@ -66,11 +67,7 @@ def train_one_epoch(
         with autocast:
             outputs = model(sagittal_t1_image, sagittal_t2_image, axial_t2_image, label)
             loss = outputs['losses']['loss']
-            total_loss += loss.item()
-
-        if not torch.isfinite(loss):
-            print(f"Loss is {loss}, stopping training")
-            sys.exit(1)
+            total_loss += loss.detach()
 
         scaler.scale(loss).backward()
 
@@ -80,10 +77,17 @@ def train_one_epoch(
         scaler.update()
         optimizer.zero_grad()
 
+        # ステップ途中で同期しないよう、lossの値はstep後に1回だけ取得する
+        # (nan/infの場合はここで終了するため、そのステップで更新された重みが保存されることはない)
+        loss_value = loss.item()
+        if not math.isfinite(loss_value):
+            print(f"Loss is {loss_value}, stopping training")
+            sys.exit(1)
+
         if use_tqdm:
             dataloader.set_postfix(
                 OrderedDict(
-                    loss=f'{loss.item():.6f}',
+                    loss=f'{loss_value:.6f}',
                     lr=f'{optimizer.param_groups[0]["lr"]:.3e}'
                 )
             )
@@ -91,7 +95,7 @@ def train_one_epoch(
         if scheduler is not None:
             scheduler.step()
 
-    train_loss = total_loss / len(train_dataloader)
+    train_loss = float(total_loss) / len(train_dataloader)
 
     return dict(train_loss=train_loss)
 